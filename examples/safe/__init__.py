@@ -194,7 +194,7 @@ else:
 
     # configure later used remote url for remote controlled setup with encrypted config
     serve_config = serve_prepare(shortname, timeout_sec=120)
-    remote_url = serve_config.config.config["remote_url"]
+    remote_url = serve_config.config["remote_url"]
 
     # create public config to be copied to the removeable storage device
     public_config = RemoteDownloadIgnitionConfig(
@@ -215,7 +215,7 @@ else:
     )
 
     # serve secret part of ign config via serve_once and mandatory client certificate
-    serve_data = serve_once(shortname, host_config, config=serve_config)
+    serve_data = serve_once(shortname, host_config, config=serve_config.config)
 
     # target is metal, write out real dns name
     target = hostname
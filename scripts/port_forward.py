@@ -7,6 +7,9 @@
   '--yaml-to-stdout' outputs resulting configuration yaml to STDOUT,
     merged from STDIN yaml if '--yaml-from-stdin'
 
+  '--json-from-stdin' and '--json-to-stdout' do the same with json,
+    for callers that only pass the configuration between programs
+
   can be used in combination with serve_once.py, eg.:
     r="$(printf 'serve_port: 48443\\nrequest_method: POST\\npayload: true\\nrequest_body_stdout: true\\n' \\
         | port_forward.py --yaml-from-stdin --yaml-to-stdout | serve_once.py --yes)"
@@ -15,6 +18,7 @@
 
 import argparse
 import copy
+import json
 import os
 import socket
 import sys
@@ -169,6 +173,9 @@ if __name__ == "__main__":
     parser.add_argument(
         "--yaml-from-stdin", action="store_true", help="Read input from STDIN"
     )
+    parser.add_argument(
+        "--json-from-stdin", action="store_true", help="Read json input from STDIN"
+    )
     parser.add_argument(
         "--serve-port", type=int, help="internal port to be forwarded to"
     )
@@ -195,6 +202,11 @@ if __name__ == "__main__":
         action="store_true",
         help="print resulting config YAML to STDOUT, include merged YAML from STDIN",
     )
+    parser.add_argument(
+        "--json-to-stdout",
+        action="store_true",
+        help="print resulting config JSON to STDOUT, include merged input from STDIN",
+    )
     parser.add_argument(
         "--silent",
         action="store_true",
@@ -220,6 +232,7 @@ if __name__ == "__main__":
     if not any(
         [
             args.yaml_from_stdin,
+            args.json_from_stdin,
             args.serve_port,
             args.get_public_ip,
             args.get_gateway_ip,
@@ -227,7 +240,7 @@ if __name__ == "__main__":
         ]
     ):
         error_print(
-            "Need one of '--yaml-from-stdin', '--serve-port', '--get-public-ip', '--get-gateway-ip', '--get-host-ip'",
+            "Need one of '--yaml-from-stdin', '--json-from-stdin', '--serve-port', '--get-public-ip', '--get-gateway-ip', '--get-host-ip'",
             print_help=True,
         )
 
@@ -245,13 +258,21 @@ if __name__ == "__main__":
             sys.exit(1)
         sys.exit(0)
 
-    if args.yaml_from_stdin:
+    if args.yaml_from_stdin or args.json_from_stdin:
+        stdin_arg = "--json-from-stdin" if args.json_from_stdin else "--yaml-from-stdin"
         stdin_str = sys.stdin.read()
         if not stdin_str.strip():
-            error_print("Error: Arg --yaml-from-stdin supplied, but no data from STDIN")
-        loaded_config = yaml.safe_load(stdin_str)
+            error_print(
+                "Error: Arg {} supplied, but no data from STDIN".format(stdin_arg)
+            )
+        if args.json_from_stdin:
+            loaded_config = json.loads(stdin_str)
+        else:
+            loaded_config = yaml.safe_load(stdin_str)
         if "serve_port" not in loaded_config:
-            error_print("serve_port: <port> must be part of STDIN if --yaml-from-stdin")
+            error_print(
+                "serve_port: <port> must be part of STDIN if {}".format(stdin_arg)
+            )
         if "port_forward" not in loaded_config:
             loaded_config["port_forward"] = {}
 
@@ -286,8 +307,10 @@ if __name__ == "__main__":
     config["port_forward"]["public_ip"] = this_public_ip
     config["port_forward"]["public_port"] = this_public_port
 
-    # print updated config to STDOUT if --yaml-to-stdout
-    if args.yaml_to_stdout:
+    # print updated config to STDOUT if --yaml-to-stdout or --json-to-stdout
+    if args.json_to_stdout:
+        print(json.dumps(config))
+    elif args.yaml_to_stdout:
         print(yaml.safe_dump(config))
     elif not args.silent:
         print("{}:{}".format(this_public_ip, this_public_port))
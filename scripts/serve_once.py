@@ -7,9 +7,10 @@ can be used
   as one-time secure data serve for eg. ignition data
   as a webhook on demand where the POST data is sent to STDOUT
 
-calling usage: <yaml-from-STDIN> | $0 [--verbose] --yes | [<request_body-to-STDOUT>]
+calling usage: <yaml-from-STDIN> | $0 [--verbose] [--json-from-stdin] --yes | [<request_body-to-STDOUT>]
 
 notes:
+- '--json-from-stdin' parses the config from STDIN as json instead of yaml
 - if key or cert is None, a temporary self-signed cert will be created
 - if mtls is true, ca_cert must be set, and a mandatory client certificate is needed to connect
 - if mtls_clientid is not None, the client certificate CN name needs to match mtls_clientid
@@ -22,6 +23,7 @@ import argparse
 import copy
 import datetime
 import http.server
+import json
 import os
 import select
 import shutil
@@ -314,6 +316,12 @@ if __name__ == "__main__":
         default=False,
         help="Log and Warnings to stderr",
     )
+    parser.add_argument(
+        "--json-from-stdin",
+        action="store_true",
+        default=False,
+        help="Read json instead of yaml config from STDIN",
+    )
     parser.add_argument(
         "--yes", action="store_true", required=True, help="Confirm execution"
     )
@@ -328,6 +336,8 @@ if __name__ == "__main__":
     if not stdin_str.strip():
         verbose_print("Warning: no configuration from stdin, using only defaults!")
         loaded_config = {}
+    elif args.json_from_stdin:
+        loaded_config = json.loads(stdin_str)
     else:
         loaded_config = yaml.safe_load(stdin_str)
 
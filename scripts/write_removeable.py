@@ -6,6 +6,8 @@
 """
 
 import argparse
+import errno
+import mmap
 import os
 import sys
 
@@ -108,7 +110,7 @@ def write_to_device(block_device_path, image_file, bus):
         with os.fdopen(fd, "wb") as target_handle:
             filesize = os.fstat(image_handle.fileno()).st_size
             current_offset = 0
-            chunk_size = pow(2, 20)
+            chunk_size = pow(2, 21)
 
             with tqdm.tqdm(
                 total=filesize,
@@ -117,13 +119,44 @@ def write_to_device(block_device_path, image_file, bus):
                 desc="Writing",
                 initial=current_offset,
             ) as pbar:
-                while True:
-                    # write chunk to device
-                    data = image_handle.read(chunk_size)
-                    if not data:
-                        break
-                    pbar.update(len(data))
-                    target_handle.write(data)
+                # copy in kernel, without passing the data through python
+                try:
+                    while current_offset < filesize:
+                        sent = os.sendfile(
+                            target_handle.fileno(),
+                            image_handle.fileno(),
+                            current_offset,
+                            min(chunk_size, filesize - current_offset),
+                        )
+                        if not sent:
+                            break
+                        current_offset += sent
+                        pbar.update(sent)
+                except OSError as e:
+                    # sendfile to this target unsupported, copy the rest from a mmap
+                    if e.errno not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+                        raise
+
+                    # write slices of the mapped image, read ahead by the kernel
+                    target_handle.seek(current_offset)
+                    with mmap.mmap(
+                        image_handle.fileno(), 0, access=mmap.ACCESS_READ
+                    ) as mm:
+                        if hasattr(mm, "madvise"):
+                            mm.madvise(mmap.MADV_SEQUENTIAL)
+                        with memoryview(mm) as view:
+                            while current_offset < filesize:
+                                end = min(current_offset + chunk_size, filesize)
+                                if hasattr(mm, "madvise"):
+                                    # madvise start has to be page aligned
+                                    start = current_offset - (
+                                        current_offset % mmap.PAGESIZE
+                                    )
+                                    mm.madvise(mmap.MADV_WILLNEED, start, end - start)
+                                # write chunk to device
+                                written = target_handle.write(view[current_offset:end])
+                                current_offset += written
+                                pbar.update(written)
 
 
 def main():
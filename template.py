@@ -24,6 +24,7 @@
 
 import base64
 import copy
+import functools
 import glob
 import os
 import re
@@ -35,6 +36,10 @@ import jinja2
 import jinja2.ext
 import yaml
 
+# use libyaml C bindings if available
+YAML_DUMPER = getattr(yaml, "CSafeDumper", yaml.SafeDumper)
+YAML_LOADER = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
 
 def join_paths(basedir, *filepaths):
     """Combine filepaths with an absolute basedir, ensuring the resulting absolute path is within basedir
@@ -46,8 +51,8 @@ def join_paths(basedir, *filepaths):
     """
     if not basedir:
         basedir = "/"
-    # remove optional leading "/" of filepaths entries, because path.join cuts out parts before "/"
-    filepaths = [path[1:] if path.startswith("/") else path for path in filepaths]
+    # remove optional leading "/"s of filepaths entries, because path.join cuts out parts before "/"
+    filepaths = [path.lstrip("/") for path in filepaths]
     # check if absolute path still startswith basedir, raise ValueError if not
     targetpath = os.path.join(basedir, *filepaths)
     abspath = os.path.abspath(targetpath)
@@ -224,7 +229,26 @@ class ToolsExtension(jinja2.ext.Extension):
         """converts a python object to a YAML string
         inline: boolean indicating whether to use inline style for the YAML output
         """
-        return yaml.safe_dump(value, default_flow_style=inline)
+        return yaml.dump(value, Dumper=YAML_DUMPER, default_flow_style=inline)
+
+
+@functools.lru_cache(maxsize=64)
+def _jinja_env(searchpath):
+    "jinja Environment shared per searchpath tuple, so loaded templates stay compiled"
+    return jinja2.Environment(
+        loader=jinja2.FileSystemLoader(searchpath), extensions=[ToolsExtension]
+    )
+
+
+@functools.lru_cache(maxsize=256)
+def _jinja_from_string(searchpath, template_str):
+    return _jinja_env(searchpath).from_string(template_str)
+
+
+def _searchpath_key(searchpath):
+    if isinstance(searchpath, (str, os.PathLike)):
+        return (searchpath,)
+    return tuple(searchpath)
 
 
 def jinja_run(template_str, searchpath, environment={}):
@@ -233,10 +257,7 @@ def jinja_run(template_str, searchpath, environment={}):
     - searchpath can be string, or list of strings, file related filter only search searchpath
 
     """
-    env = jinja2.Environment(
-        loader=jinja2.FileSystemLoader(searchpath), extensions=[ToolsExtension]
-    )
-    template = env.from_string(template_str)
+    template = _jinja_from_string(_searchpath_key(searchpath), template_str)
     rendered = template.render(environment)
     return rendered
 
@@ -247,9 +268,7 @@ def jinja_run_file(template_filename, searchpath, environment={}):
     - searchpath can be a list of strings, template_filename can be from any searchpath
 
     """
-    env = jinja2.Environment(
-        loader=jinja2.FileSystemLoader(searchpath), extensions=[ToolsExtension]
-    )
+    env = _jinja_env(_searchpath_key(searchpath))
     template = env.get_template(template_filename)
     rendered = template.render(environment)
     return rendered
@@ -275,7 +294,9 @@ def load_butane_dir(basedir, environment, subdir="", exclude=[], include=[]):
         ]
 
     for fname in files:
-        source_dict = yaml.safe_load(jinja_run_file(fname, basedir, environment))
+        source_dict = yaml.load(
+            jinja_run_file(fname, basedir, environment), Loader=YAML_LOADER
+        )
         inlined_dict = inline_local_files(source_dict, basedir)
         expanded_dict = expand_templates(inlined_dict, basedir, environment)
         merged_dict = merge_butane_dicts(merged_dict, expanded_dict)
@@ -31,54 +31,279 @@ debug:
 
 ### Python
 - sha256sum_file
+- fingerprint_file
 - get_default_host_ip
+- invalidate_ip_cache
+- exec_cmdline
 
 """
 
-import copy
+import atexit
+import base64
+import concurrent.futures
+import functools
+import gzip
 import hashlib
+import io
+import json
+import mmap
 import os
 import random
+import shlex
 import socket
+import sqlite3
+import tarfile
+import threading
 import time
 
 import pulumi
-import pulumi_command as command
 import yaml
 
 from pulumi.dynamic import Resource, ResourceProvider, CreateResult, UpdateResult
-from .template import join_paths
+from .template import YAML_DUMPER, YAML_LOADER, join_paths
 
 this_dir = os.path.dirname(os.path.abspath(__file__))
 project_dir = os.path.abspath(os.path.join(this_dir, ".."))
+scripts_dir = os.path.join(this_dir, "scripts")
+
+# yaml dump and load, using libyaml C bindings if available
+_dump = functools.partial(yaml.dump, Dumper=YAML_DUMPER)
+_load = functools.partial(yaml.load, Loader=YAML_LOADER)
+_TOP_SLS = "base:\n  '*':\n    - main\n"
+
+
+def _dump_pillar(pillar):
+    "yaml of a salt pillar, the common empty pillar without calling the emitter"
+    return _dump(pillar) if pillar else "{}\n"
+
+
+@functools.lru_cache(maxsize=1)
+def _stack_name():
+    "pulumi stack name, fixed for the lifetime of the program"
+    return pulumi.get_stack()
+
+
+# directories already created by this process
+_made_dirs = set()
+
+
+def _ensure_dir(path):
+    "os.makedirs(path, exist_ok=True), but only once per path and process"
+    if path not in _made_dirs:
+        os.makedirs(path, exist_ok=True)
+        _made_dirs.add(path)
+
+
+def exec_cmdline(*argv):
+    "shell cmdline that replaces the shell with argv, so no extra shell process stays around"
+    return "exec " + shlex.join([str(arg) for arg in argv])
+
+
+def _maybe_apply(value, fn):
+    "fn(value) for plain values, value.apply(fn) only if value is an Output"
+    if isinstance(value, pulumi.Output):
+        return value.apply(fn)
+    return fn(value)
+
+
+def _tar_files(files, mode):
+    "in memory tar of {name: str}, with fixed metadata so same files give same bytes"
+    buf = io.BytesIO()
+    with tarfile.open(fileobj=buf, mode="w", format=tarfile.GNU_FORMAT) as tar:
+        for name, data in files.items():
+            content = data.encode("utf-8")
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            info.mode = mode
+            tar.addfile(info, io.BytesIO(content))
+    return buf.getvalue()
+
+
+def _tgz_local_files(files):
+    "in memory tar.gz of {name: local path}, file modes kept, other metadata fixed"
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode="wb", mtime=0) as gz:
+        with tarfile.open(fileobj=gz, mode="w", format=tarfile.GNU_FORMAT) as tar:
+            for name, local_path in files.items():
+                with open(local_path, "rb") as f:
+                    info = tar.gettarinfo(arcname=name, fileobj=f)
+                    info.mtime = 0
+                    info.uid = info.gid = 0
+                    info.uname = info.gname = ""
+                    tar.addfile(info, f)
+    return buf.getvalue()
 
 
 def log_warn(x):
     "write str(var) to pulumi.log.warn with line numbering, to be used as var.apply(log_warn)"
-    pulumi.log.warn(
-        "\n".join(
-            [
-                "{}:{}".format(nr + 1, line)
-                for nr, line in enumerate(str(x).splitlines())
-            ]
-        )
-    )
+    buf = io.StringIO()
+    for nr, line in enumerate(str(x).splitlines(), 1):
+        if nr > 1:
+            buf.write("\n")
+        buf.write(str(nr))
+        buf.write(":")
+        buf.write(line)
+    pulumi.log.warn(buf.getvalue())
 
 
-def sha256sum_file(filename):
-    "sha256sum of file, logically backported from python 3.11"
+# files at or above this size are hashed from a memory map
+_MMAP_HASH_MIN_SIZE = 10 * 2**20
+# python >= 3.11
+_HAS_FILE_DIGEST = hasattr(hashlib, "file_digest")
+
+
+def _hash_file(h, filename):
+    "update hash object h with the contents of filename, return hexdigest"
 
-    h = hashlib.sha256()
-    buf = bytearray(2**18)
-    view = memoryview(buf)
     with open(filename, "rb", buffering=0) as f:
+        if os.fstat(f.fileno()).st_size >= _MMAP_HASH_MIN_SIZE:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mm, "madvise"):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                h.update(mm)
+            return h.hexdigest()
+
+        if _HAS_FILE_DIGEST:
+            return hashlib.file_digest(f, lambda: h).hexdigest()
+
+        buf = bytearray(2**20)
+        view = memoryview(buf)
         while n := f.readinto(view):
             h.update(view[:n])
     return h.hexdigest()
 
 
+# regenerable on-disk cache of file hashes, shared between pulumi runs
+_hash_db = None
+_hash_db_lock = threading.Lock()
+
+
+def _get_hash_db():
+    "sqlite db of state/cache/hashes.sqlite, opened on first use"
+    global _hash_db
+    if _hash_db is None:
+        cache_dir = os.path.join(project_dir, "state", "cache")
+        _ensure_dir(cache_dir)
+        db = sqlite3.connect(
+            os.path.join(cache_dir, "hashes.sqlite"),
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        db.execute("PRAGMA synchronous=OFF")
+        db.execute("PRAGMA journal_mode=MEMORY")
+        # table of earlier versions had no ctime_ns, its entries are not trusted
+        db.execute("DROP TABLE IF EXISTS hashes")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS file_hashes (kind TEXT, path TEXT, "
+            "mtime_ns INTEGER, ctime_ns INTEGER, size INTEGER, ino INTEGER, "
+            "hash TEXT, PRIMARY KEY (kind, path))"
+        )
+        atexit.register(db.close)
+        _hash_db = db
+    return _hash_db
+
+
+@functools.lru_cache(maxsize=4096)
+def _cached_hash_file(kind, filename, mtime_ns, ctime_ns, size, ino):
+    "hash of unchanged file (same path, mtime, ctime, size and inode) is only computed once"
+    key = (kind, filename, mtime_ns, ctime_ns, size, ino)
+    try:
+        with _hash_db_lock:
+            row = (
+                _get_hash_db()
+                .execute(
+                    "SELECT hash FROM file_hashes WHERE kind=? AND path=? "
+                    "AND mtime_ns=? AND ctime_ns=? AND size=? AND ino=?",
+                    key,
+                )
+                .fetchone()
+            )
+        if row:
+            return row[0]
+    except (OSError, sqlite3.Error):
+        pass
+
+    digest = _hash_file(
+        hashlib.sha256() if kind == "sha256" else _fingerprint_hash(), filename
+    )
+    try:
+        with _hash_db_lock:
+            _get_hash_db().execute(
+                "INSERT OR REPLACE INTO file_hashes VALUES (?, ?, ?, ?, ?, ?, ?)",
+                key + (digest,),
+            )
+    except (OSError, sqlite3.Error):
+        pass
+    return digest
+
+
+def _stat_key(filename):
+    # ctime can not be set by cp -p, rsync -a or touch -r, unlike mtime
+    st = os.stat(filename)
+    return (
+        os.path.abspath(filename),
+        st.st_mtime_ns,
+        st.st_ctime_ns,
+        st.st_size,
+        st.st_ino,
+    )
+
+
+def sha256sum_file(filename):
+    "sha256sum of file, logically backported from python 3.11, mmap for large files"
+    return _cached_hash_file("sha256", *_stat_key(filename))
+
+
+def _fingerprint_hash():
+    "new hash object for content fingerprints, fixed so triggers are stable across machines"
+    return hashlib.blake2b(digest_size=32)
+
+
+def _fingerprint(data):
+    "content fingerprint of bytes, only used for change detection in triggers"
+    h = _fingerprint_hash()
+    h.update(data)
+    return h.hexdigest()
+
+
+def _fingerprint_data(x):
+    "content fingerprint of str(x), bytes are used as is, to be used as data.apply(...)"
+    if isinstance(x, str):
+        return _fingerprint(x.encode("utf-8"))
+    if isinstance(x, (bytes, bytearray)):
+        return _fingerprint(x)
+    return _fingerprint(str(x).encode("utf-8"))
+
+
+def fingerprint_file(filename):
+    "content fingerprint of file for change detection, not comparable to sha256sum output"
+    return _cached_hash_file("fingerprint", *_stat_key(filename))
+
+
+def _fingerprint_files(filenames):
+    "{filename: fingerprint_file(filename)}, files are hashed in parallel threads"
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=min(8, os.cpu_count() or 1)
+    ) as executor:
+        return dict(zip(filenames, executor.map(fingerprint_file, filenames)))
+
+
+# host ip lookups are cached for this many seconds
+_HOST_IP_TTL_SEC = 300
+
+
 def get_default_host_ip():
-    "return ip of host connected to the outside, or None if not found"
+    "return ip of host connected to the outside, or None if not found, cached for some minutes"
+    return _default_host_ip(int(time.monotonic() // _HOST_IP_TTL_SEC))
+
+
+def invalidate_ip_cache():
+    "forget cached results of get_default_host_ip"
+    _default_host_ip.cache_clear()
+
+
+@functools.lru_cache(maxsize=1)
+def _default_host_ip(ttl_slot):
     try:
         gateway_addr = socket.gethostbyname(socket.gethostname())
         if (
@@ -96,53 +321,122 @@ class SSHPut(pulumi.ComponentResource):
     """Pulumi Component: use with function ssh_put()"""
 
     def __init__(self, name, props, opts=None):
+        import pulumi_command as command
+
         super().__init__("pkg:index:SSHPut", name, None, opts)
 
         self.props = props
         self.triggers = []
-        for key, value in self.props["files"].items():
-            setattr(self, key, self.__transfer(name, key, value))
+        # one connection, shared by all files of this component
+        self.__connection = command.remote.ConnectionArgs(
+            host=props["host"],
+            port=props["port"],
+            user=props["user"],
+            private_key=props["sshkey"].private_key_openssh,
+        )
+        self.__fingerprints = _fingerprint_files(
+            [
+                join_paths(self.props["local_prefix"], local_path)
+                for local_path in self.props["files"].values()
+            ]
+        )
+        if self.props["simulate"]:
+            # one local command copies all files
+            file_transfered = self.__simulate(name)
+            for key in self.props["files"]:
+                setattr(self, key, file_transfered)
+        elif self.props["batch"]:
+            # one remote command extracts all files
+            file_transfered = self.__transfer_batch(name)
+            for key in self.props["files"]:
+                setattr(self, key, file_transfered)
+        else:
+            for key, value in self.props["files"].items():
+                setattr(self, key, self.__transfer(name, key, value))
         self.register_outputs({})
 
-    def __transfer(self, name, remote_path, local_path):
-        resource_name = "{}_put_{}".format(name, remote_path.replace("/", "_"))
+    def __paths_and_triggers(self, remote_path, local_path):
         full_remote_path = join_paths(self.props["remote_prefix"], remote_path)
         full_local_path = join_paths(self.props["local_prefix"], local_path)
         triggers = [
-            hashlib.sha256(full_remote_path.encode("utf-8")).hexdigest(),
-            pulumi.Output.concat(sha256sum_file(full_local_path)),
+            full_remote_path,
+            pulumi.Output.concat(self.__fingerprints[full_local_path]),
         ]
         self.triggers.extend(triggers)
+        return full_remote_path, full_local_path, triggers
 
-        if self.props["simulate"]:
-            os.makedirs(self.props["tmpdir"], exist_ok=True)
+    def __simulate(self, name):
+        import pulumi_command as command
+
+        _ensure_dir(self.props["tmpdir"])
+        copy_cmds, rm_cmds = ["set -e"], []
+        for remote_path, local_path in self.props["files"].items():
+            resource_name = "{}_put_{}".format(name, remote_path.replace("/", "_"))
+            _, full_local_path, _ = self.__paths_and_triggers(remote_path, local_path)
             tmpfile = os.path.abspath(os.path.join(self.props["tmpdir"], resource_name))
-            copy_cmd = "cp {} {}"
-            rm_cmd = "rm {} || true" if self.props["delete"] else ""
+            copy_cmds.append("cp {} {}".format(full_local_path, tmpfile))
+            rm_cmds.append("rm {} || true".format(tmpfile))
+
+        return command.local.Command(
+            "{}_put_simulate".format(name),
+            create="\n".join(copy_cmds),
+            delete="\n".join(rm_cmds) if self.props["delete"] else "",
+            triggers=self.triggers,
+            opts=pulumi.ResourceOptions(parent=self),
+        )
 
-            file_transfered = command.local.Command(
-                resource_name,
-                create=copy_cmd.format(full_local_path, tmpfile),
-                delete=rm_cmd.format(tmpfile),
-                triggers=triggers,
-                opts=pulumi.ResourceOptions(parent=self),
-            )
-        else:
-            file_transfered = command.remote.CopyFile(
-                resource_name,
-                local_path=full_local_path,
-                remote_path=full_remote_path,
-                connection=command.remote.ConnectionArgs(
-                    host=self.props["host"],
-                    port=self.props["port"],
-                    user=self.props["user"],
-                    private_key=self.props["sshkey"].private_key_openssh.apply(
-                        lambda x: x
-                    ),
-                ),
-                triggers=triggers,
-                opts=pulumi.ResourceOptions(parent=self),
+    def __transfer_batch(self, name):
+        import pulumi_command as command
+
+        archive_files = {}
+        for remote_path, local_path in self.props["files"].items():
+            full_remote_path, full_local_path, _ = self.__paths_and_triggers(
+                remote_path, local_path
             )
+            archive_files[full_remote_path.lstrip("/")] = full_local_path
+
+        extract_cmd = "base64 -d | tar -x -z -m -f - -C /"
+        return command.remote.Command(
+            "{}_put_batch".format(name),
+            connection=self.__connection,
+            create=extract_cmd,
+            update=extract_cmd,
+            delete=(
+                "rm {} || true".format(
+                    " ".join(shlex.quote("/" + path) for path in archive_files)
+                )
+                if self.props["delete"]
+                else ""
+            ),
+            # file contents end up in the state, keep them encrypted there
+            stdin=pulumi.Output.secret(
+                base64.b64encode(_tgz_local_files(archive_files)).decode("ascii")
+            ),
+            triggers=self.triggers,
+            # a changed path list replaces the command, so removed files get deleted,
+            # delete first, so rm of the old list does not remove the new files
+            opts=pulumi.ResourceOptions(
+                parent=self,
+                replace_on_changes=["delete"],
+                delete_before_replace=True,
+            ),
+        )
+
+    def __transfer(self, name, remote_path, local_path):
+        import pulumi_command as command
+
+        resource_name = "{}_put_{}".format(name, remote_path.replace("/", "_"))
+        full_remote_path, full_local_path, triggers = self.__paths_and_triggers(
+            remote_path, local_path
+        )
+        file_transfered = command.remote.CopyFile(
+            resource_name,
+            local_path=full_local_path,
+            remote_path=full_remote_path,
+            connection=self.__connection,
+            triggers=triggers,
+            opts=pulumi.ResourceOptions(parent=self),
+        )
         return file_transfered
 
 
@@ -190,17 +484,19 @@ class SSHGet(pulumi.ComponentResource):
         self.register_outputs({})
 
     def __transfer(self, name, remote_path, local_path):
+        import pulumi_command as command
+
         resource_name = "get_{}".format(remote_path.replace("/", "_"))
         full_remote_path = join_paths(self.props["remote_prefix"], remote_path)
         full_local_path = join_paths(self.props["local_prefix"], local_path)
         triggers = [
-            hashlib.sha256(full_remote_path.encode("utf-8")).hexdigest(),
-            pulumi.Output.concat(sha256sum_file(full_local_path)),
+            full_remote_path,
+            pulumi.Output.concat(fingerprint_file(full_local_path)),
         ]
         self.triggers.extend(triggers)
 
         if self.props["simulate"]:
-            os.makedirs(self.props["tmpdir"], exist_ok=True)
+            _ensure_dir(self.props["tmpdir"])
             tmpfile = os.path.abspath(os.path.join(self.props["tmpdir"], resource_name))
             copy_cmd = "cp {} {}"
             rm_cmd = "rm {} || true" if self.props["delete"] else ""
@@ -233,64 +529,127 @@ class SSHDeployer(pulumi.ComponentResource):
     """Pulumi Component: use with function ssh_deploy()"""
 
     def __init__(self, name, props, opts=None):
+        import pulumi_command as command
+
         super().__init__("pkg:index:SSHDeployer", name, None, opts)
 
         self.props = props
         self.triggers = []
-        for key, value in self.props["files"].items():
-            setattr(self, key, self.__deploy(name, key, value))
-        self.register_outputs({})
-
-    def __deploy(self, name, remote_path, data):
-        resource_name = "{}_deploy_{}".format(name, remote_path.replace("/", "_"))
-        cat_cmd = (
+        # one connection, shared by all files of this component
+        self.__connection = command.remote.ConnectionArgs(
+            host=props["host"],
+            port=props["port"],
+            user=props["user"],
+            private_key=props["sshkey"].private_key_openssh,
+        )
+        # command templates are the same for every file of this deployer
+        self.__cat_cmd = (
             'x="{}" && mkdir -m 0700 -p $(dirname "$x") && umask 066 && cat - > "$x"'
             if self.props["secret"]
             else 'x="{}" && mkdir -p $(dirname "$x") && cat - > "$x"'
         )
-        rm_cmd = "rm {} || true" if self.props["delete"] else ""
+        self.__rm_cmd = "rm {} || true" if self.props["delete"] else ""
+        if self.props["batch"] and not self.props["simulate"]:
+            deployed = self.__deploy_batch(name)
+            for key in self.props["files"]:
+                setattr(self, key, deployed)
+        else:
+            for key, value in self.props["files"].items():
+                setattr(self, key, self.__deploy(name, key, value))
+        self.register_outputs({})
+
+    def __deploy_batch(self, name):
+        import pulumi_command as command
+
+        files = {
+            join_paths(self.props["remote_prefix"], remote_path): data
+            for remote_path, data in self.props["files"].items()
+        }
+        for path, data in files.items():
+            self.triggers.extend([path, _maybe_apply(data, _fingerprint_data)])
+
+        # one tar stream, extracted by a single remote command
+        names = [path.lstrip("/") for path in files]
+        mode = 0o600 if self.props["secret"] else 0o644
+        stdin = pulumi.Output.all(*files.values()).apply(
+            lambda datas: base64.b64encode(
+                _tar_files(dict(zip(names, [str(data) for data in datas])), mode)
+            ).decode("ascii")
+        )
+        extract_cmd = "{}base64 -d | tar -x -m -f - -C /".format(
+            "umask 077 && " if self.props["secret"] else ""
+        )
+        return command.remote.Command(
+            "{}_deploy_batch".format(name),
+            connection=self.__connection,
+            create=extract_cmd,
+            update=extract_cmd,
+            delete=self.__rm_cmd.format(" ".join(shlex.quote(path) for path in files)),
+            stdin=stdin,
+            triggers=list(self.triggers),
+            # a changed path list replaces the command, so removed files get deleted,
+            # delete first, so rm of the old list does not remove the new files
+            opts=pulumi.ResourceOptions(
+                parent=self,
+                replace_on_changes=["delete"],
+                delete_before_replace=True,
+            ),
+        )
+
+    def __deploy(self, name, remote_path, data):
+        import pulumi_command as command
+
+        resource_name = "{}_deploy_{}".format(name, remote_path.replace("/", "_"))
         full_remote_path = join_paths(self.props["remote_prefix"], remote_path)
         triggers = [
-            hashlib.sha256(
-                cat_cmd.format(full_remote_path).encode("utf-8")
-            ).hexdigest(),
-            data.apply(lambda x: hashlib.sha256(str(x).encode("utf-8")).hexdigest()),
+            full_remote_path,
+            _maybe_apply(data, _fingerprint_data),
         ]
         self.triggers.extend(triggers)
+        stdin = _maybe_apply(data, str)
 
         if self.props["simulate"]:
-            os.makedirs(self.props["tmpdir"], exist_ok=True)
+            _ensure_dir(self.props["tmpdir"])
             tmpfile = os.path.abspath(os.path.join(self.props["tmpdir"], resource_name))
+            cat_cmd = self.__cat_cmd.format(tmpfile)
             value_deployed = command.local.Command(
                 resource_name,
-                create=cat_cmd.format(tmpfile),
-                update=cat_cmd.format(tmpfile),
-                delete=rm_cmd.format(tmpfile),
-                stdin=data.apply(lambda x: str(x)),
+                create=cat_cmd,
+                update=cat_cmd,
+                delete=self.__rm_cmd.format(tmpfile),
+                stdin=stdin,
                 triggers=triggers,
                 opts=pulumi.ResourceOptions(parent=self),
             )
         else:
+            cat_cmd = self.__cat_cmd.format(full_remote_path)
             value_deployed = command.remote.Command(
                 resource_name,
-                connection=command.remote.ConnectionArgs(
-                    host=self.props["host"],
-                    port=self.props["port"],
-                    user=self.props["user"],
-                    private_key=self.props["sshkey"].private_key_openssh.apply(
-                        lambda x: x
-                    ),
-                ),
-                create=cat_cmd.format(full_remote_path),
-                update=cat_cmd.format(full_remote_path),
-                delete=rm_cmd.format(full_remote_path),
-                stdin=data.apply(lambda x: str(x)),
+                connection=self.__connection,
+                create=cat_cmd,
+                update=cat_cmd,
+                delete=self.__rm_cmd.format(full_remote_path),
+                stdin=stdin,
                 triggers=triggers,
                 opts=pulumi.ResourceOptions(parent=self),
             )
         return value_deployed
 
 
+_ssh_factory = None
+
+
+def _get_ssh_factory():
+    "authority.ssh_factory, imported on first use to avoid an import cycle"
+    global _ssh_factory
+
+    if _ssh_factory is None:
+        from .authority import ssh_factory
+
+        _ssh_factory = ssh_factory
+    return _ssh_factory
+
+
 def ssh_put(
     prefix,
     host,
@@ -301,6 +660,7 @@ def ssh_put(
     port=22,
     delete=False,
     simulate=None,
+    batch=False,
     opts=None,
 ):
     """copy/put a set of files from localhost to ssh target using ssh/sftp
@@ -313,9 +673,12 @@ def ssh_put(
     if delete==True: files will be deleted from target on deletion of resource
     if simulate==True: files are not transfered but written out to state/tmp/stack_name
     if simulate==None: simulate=pulumi.get_stack().endswith("sim")
+    if batch==True: all files are sent as one tar.gz to one remote command (one ssh session),
+        needs base64 and tar on target, file modes are kept, every attr points to that command.
+        The archive is part of the command input (stored as secret), so use it for many small files
 
     #### Returns
-    - [attr(remotepath, remote.CopyFile|local.Command) for remotepath in files]
+    - [attr(remotepath, remote.CopyFile|remote.Command|local.Command) for remotepath in files]
     - triggers: list of key and data hashes for every file
         - can be used for triggering another function if any file changed
 
@@ -328,9 +691,9 @@ def ssh_put(
     ```
     """
 
-    from .authority import ssh_factory
+    ssh_factory = _get_ssh_factory()
 
-    stack_name = pulumi.get_stack()
+    stack_name = _stack_name()
     props = {
         "host": host,
         "port": port,
@@ -341,6 +704,7 @@ def ssh_put(
         "remote_prefix": remote_prefix,
         "local_prefix": local_prefix,
         "simulate": stack_name.endswith("sim") if simulate is None else simulate,
+        "batch": batch,
         "tmpdir": os.path.join(project_dir, "state", "tmp", stack_name),
     }
     transfered = SSHPut(prefix, props, opts=opts)
@@ -376,9 +740,9 @@ def ssh_get(
         - can be used for triggering another function if any file changed
     """
 
-    from .authority import ssh_factory
+    ssh_factory = _get_ssh_factory()
 
-    stack_name = pulumi.get_stack()
+    stack_name = _stack_name()
     props = {
         "host": host,
         "port": port,
@@ -405,12 +769,15 @@ def ssh_deploy(
     secret=False,
     delete=False,
     simulate=None,
+    batch=False,
     opts=None,
 ):
     """deploy a set of strings as small files to a ssh target
 
     if secret==True: data is considered a secret, file mode will be 0600, dir mode will be 0700
     if delete==True: files will be deleted from target on deletion of resource
+    if batch==True: all files are written by one remote command (one ssh session),
+        as a tar stream, needs base64 and tar on target, every attr points to that command
     if simulate==True: data is not transfered but written out to state/tmp/stack_name
     if simulate==None: simulate=pulumi.get_stack().endswith("sim")
 
@@ -419,6 +786,7 @@ def ssh_deploy(
 
     #### Returns
     - [attr(remotepath, remote.Command|local.Command) for remotepath in files]
+        - if batch==True: every attr is the same single remote.Command for all files
     - triggers: list of key and data hashes for every file,
         - can be used for triggering another function if any file changed
 
@@ -430,9 +798,9 @@ def ssh_deploy(
         opts=pulumi.ResourceOptions(depends_on=[config_deployed]))
     ```
     """
-    from .authority import ssh_factory
+    ssh_factory = _get_ssh_factory()
 
-    stack_name = pulumi.get_stack()
+    stack_name = _stack_name()
     props = {
         "host": host,
         "port": port,
@@ -443,6 +811,7 @@ def ssh_deploy(
         "secret": secret,
         "delete": delete,
         "simulate": stack_name.endswith("sim") if simulate is None else simulate,
+        "batch": batch,
         "tmpdir": os.path.join(project_dir, "state", "tmp", stack_name),
     }
     deployed = SSHDeployer(prefix, props, opts=opts)
@@ -471,15 +840,17 @@ def ssh_execute(
 
     """
 
-    from .authority import ssh_factory
+    import pulumi_command as command
+
+    ssh_factory = _get_ssh_factory()
 
     resource_name = "{}_ssh_execute".format(prefix)
-    stack_name = pulumi.get_stack()
+    stack_name = _stack_name()
     simulate = stack_name.endswith("sim") if simulate is None else simulate
 
     if simulate:
         tmpdir = os.path.join(project_dir, "state", "tmp", stack_name)
-        os.makedirs(tmpdir, exist_ok=True)
+        _ensure_dir(tmpdir)
         # XXX write out environment if not empty on simulate, so we can look what env was set
         if environment != {}:
             cmdline = (
@@ -502,9 +873,7 @@ def ssh_execute(
                 host=host,
                 port=port,
                 user=user,
-                private_key=ssh_factory.provision_key.private_key_openssh.apply(
-                    lambda x: x
-                ),
+                private_key=ssh_factory.provision_key.private_key_openssh,
             ),
             create=cmdline,
             triggers=triggers,
@@ -525,11 +894,13 @@ class DataExport(pulumi.ComponentResource):
     def __init__(
         self, prefix, filename, data, key=None, filter="", delete=False, opts=None
     ):
+        import pulumi_command as command
+
         super().__init__(
             "pkg:index:DataExport", "_".join([prefix, filename]), None, opts
         )
 
-        stack_name = pulumi.get_stack()
+        stack_name = _stack_name()
         filter += " | " if filter else ""
 
         if key:
@@ -564,7 +935,7 @@ class DataExport(pulumi.ComponentResource):
         )
         delete_cmd = "rm {} | true".format(self.filename) if delete else ""
 
-        os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+        _ensure_dir(os.path.dirname(self.filename))
 
         self.saved = command.local.Command(
             resource_name,
@@ -575,9 +946,7 @@ class DataExport(pulumi.ComponentResource):
             opts=opts,
             dir=project_dir,
             triggers=[
-                data.apply(
-                    lambda x: hashlib.sha256(str(x).encode("utf-8")).hexdigest()
-                ),
+                _maybe_apply(data, _fingerprint_data),
             ],
         )
         self.register_outputs({})
@@ -586,7 +955,7 @@ class DataExport(pulumi.ComponentResource):
 def encrypted_local_export(prefix, filename, data, filter="", delete=False, opts=None):
     "store sensitive state data age encrypted in state/files/"
 
-    from .authority import ssh_factory
+    ssh_factory = _get_ssh_factory()
 
     return DataExport(
         prefix,
@@ -625,45 +994,31 @@ def salt_config(
     sls_dir = sls_dir if sls_dir else base_dir
     pillar_dir = os.path.join(root_dir, "pillar")
 
-    config = yaml.safe_load(
-        """
-id: {resource_name}
-local: True
-log_level_logfile: info
-file_client: local
-fileserver_backend:
-- roots
-file_roots:
-  base:
-  - {sls_dir}
-pillar_roots:
-  base:
-  - {pillar_dir}
-grains:
-  resource_name: {resource_name}
-  base_dir: {base_dir}
-  root_dir: {root_dir}
-  tmp_dir: {tmp_dir}
-  sls_dir: {sls_dir}
-  pillar_dir: {pillar_dir}
-root_dir: {root_dir}
-conf_file: {root_dir}/minion
-pki_dir: {root_dir}/etc/salt/pki/minion
-pidfile: {root_dir}/var/run/salt-minion.pid
-sock_dir: {root_dir}/var/run/salt/minion
-cachedir: {root_dir}/var/cache/salt/minion
-extension_modules: {root_dir}/var/cache/salt/minion/extmods
-log_file: {root_dir}/var/log/salt/minion
-
-""".format(
-            resource_name=resource_name,
-            base_dir=base_dir,
-            root_dir=root_dir,
-            tmp_dir=tmp_dir,
-            sls_dir=sls_dir,
-            pillar_dir=pillar_dir,
-        )
-    )
+    config = {
+        "id": resource_name,
+        "local": True,
+        "log_level_logfile": "info",
+        "file_client": "local",
+        "fileserver_backend": ["roots"],
+        "file_roots": {"base": [sls_dir]},
+        "pillar_roots": {"base": [pillar_dir]},
+        "grains": {
+            "resource_name": resource_name,
+            "base_dir": base_dir,
+            "root_dir": root_dir,
+            "tmp_dir": tmp_dir,
+            "sls_dir": sls_dir,
+            "pillar_dir": pillar_dir,
+        },
+        "root_dir": root_dir,
+        "conf_file": root_dir + "/minion",
+        "pki_dir": root_dir + "/etc/salt/pki/minion",
+        "pidfile": root_dir + "/var/run/salt-minion.pid",
+        "sock_dir": root_dir + "/var/run/salt/minion",
+        "cachedir": root_dir + "/var/cache/salt/minion",
+        "extension_modules": root_dir + "/var/cache/salt/minion/extmods",
+        "log_file": root_dir + "/var/log/salt/minion",
+    }
     return config
 
 
@@ -673,6 +1028,7 @@ class LocalSaltCall(pulumi.ComponentResource):
     - sls_dir defaults to project_dir
     - config/run/tmp/cache and other files default to state/salt/stackname
     - grains from salt_config available
+    - args are shell quoted, each arg is passed literally to salt-call
 
     #### Example: build openwrt image
     ```python
@@ -691,26 +1047,29 @@ class LocalSaltCall(pulumi.ComponentResource):
         opts=None,
         **kwargs,
     ):
+        import pulumi_command as command
+
         super().__init__("pkg:index:LocalSaltCall", resource_name, None, opts)
-        stack = pulumi.get_stack()
+        stack = _stack_name()
         self.config = salt_config(resource_name, stack, project_dir, sls_dir=sls_dir)
         pillar_dir = self.config["grains"]["pillar_dir"]
 
-        os.makedirs(self.config["root_dir"], exist_ok=True)
-        os.makedirs(pillar_dir, exist_ok=True)
+        # pillar_dir is root_dir/pillar, creating it also creates root_dir
+        _ensure_dir(pillar_dir)
 
-        with open(self.config["conf_file"], "w") as m:
-            m.write(yaml.safe_dump(self.config))
-        with open(os.path.join(pillar_dir, "top.sls"), "w") as m:
-            m.write("base:\n  '*':\n    - main\n")
-        with open(os.path.join(pillar_dir, "main.sls"), "w") as m:
-            m.write(yaml.safe_dump(pillar))
+        salt_files = {
+            self.config["conf_file"]: _dump(self.config),
+            os.path.join(pillar_dir, "top.sls"): _TOP_SLS,
+            os.path.join(pillar_dir, "main.sls"): _dump_pillar(pillar),
+        }
+        for filename, content in salt_files.items():
+            with open(filename, "w") as m:
+                m.write(content)
 
         self.executed = command.local.Command(
             resource_name,
-            create="pipenv run salt-call -c {conf_dir} {args}".format(
-                conf_dir=self.config["root_dir"],
-                args=" ".join(args),
+            create=exec_cmdline(
+                "pipenv", "run", "salt-call", "-c", self.config["root_dir"], *args
             ),
             environment=environment,
             opts=pulumi.ResourceOptions(parent=self),
@@ -726,6 +1085,7 @@ class RemoteSaltCall(pulumi.ComponentResource):
     - grains from salt_config available
     - NOTE: function replaces parameters "{base_dir}" and "{args}" in the "exec" string
         - therefore avoid (rename) shell vars named "${base_dir}" or "${args}"
+    - args are shell quoted, each arg is passed literally to salt-call
 
     """
 
@@ -753,7 +1113,7 @@ class RemoteSaltCall(pulumi.ComponentResource):
             opts,
         )
 
-        stack = pulumi.get_stack()
+        stack = _stack_name()
         self.config = salt_config(
             resource_name,
             stack,
@@ -762,25 +1122,18 @@ class RemoteSaltCall(pulumi.ComponentResource):
             tmp_dir=tmp_dir,
             sls_dir=sls_dir,
         )
-        pillar_dir = self.config["grains"]["pillar_dir"]
-        sls_dir = self.config["grains"]["sls_dir"]
-        rel_pillar_dir = os.path.relpath(pillar_dir, base_dir)
-        rel_sls_dir = os.path.relpath(sls_dir, base_dir)
+        # pillar_dir and conf_file are inside root_dir, root_dir and sls_dir
+        # may be outside of base_dir, so only these two need a relpath
+        rel_root_dir = os.path.relpath(self.config["root_dir"], base_dir)
+        rel_sls_dir = os.path.relpath(self.config["grains"]["sls_dir"], base_dir)
+        rel_pillar_dir = os.path.join(rel_root_dir, "pillar")
 
         self.config_dict = {
-            os.path.relpath(
-                self.config["conf_file"], base_dir
-            ): pulumi.Output.from_input(yaml.safe_dump(self.config)),
-            os.path.join(rel_sls_dir, "top.sls"): pulumi.Output.from_input(
-                "base:\n  '*':\n    - main\n"
-            ),
-            os.path.join(rel_sls_dir, "main.sls"): pulumi.Output.from_input(salt),
-            os.path.join(rel_pillar_dir, "top.sls"): pulumi.Output.from_input(
-                "base:\n  '*':\n    - main\n"
-            ),
-            os.path.join(rel_pillar_dir, "main.sls"): pulumi.Output.from_input(
-                yaml.safe_dump(pillar)
-            ),
+            os.path.join(rel_root_dir, "minion"): _dump(self.config),
+            os.path.join(rel_sls_dir, "top.sls"): _TOP_SLS,
+            os.path.join(rel_sls_dir, "main.sls"): salt,
+            os.path.join(rel_pillar_dir, "top.sls"): _TOP_SLS,
+            os.path.join(rel_pillar_dir, "main.sls"): _dump_pillar(pillar),
         }
 
         self.config_deployed = ssh_deploy(
@@ -790,6 +1143,7 @@ class RemoteSaltCall(pulumi.ComponentResource):
             self.config_dict,
             remote_prefix=base_dir,
             simulate=False,
+            batch=True,
             opts=pulumi.ResourceOptions(parent=self),
         )
 
@@ -798,8 +1152,8 @@ class RemoteSaltCall(pulumi.ComponentResource):
             host,
             user,
             cmdline=exec.format(
-                base_dir=self.config["root_dir"],
-                args=" ".join(args),
+                base_dir=shlex.quote(self.config["root_dir"]),
+                args=shlex.join([str(arg) for arg in args]),
             ),
             simulate=False,
             opts=pulumi.ResourceOptions(parent=self, depends_on=[self.config_deployed]),
@@ -871,6 +1225,29 @@ class TimedResource(Resource):
         )
 
 
+_tls_material = None
+
+
+def _get_tls_material():
+    "shared Output of [chain, key, ca_cert] of the provision host tls, resolved once per stack"
+    global _tls_material
+
+    if _tls_material is None:
+        from .authority import ca_factory, provision_host_tls
+
+        _tls_material = pulumi.Output.all(
+            provision_host_tls.chain,
+            provision_host_tls.key.private_key_pem,
+            ca_factory.root_cert_pem,
+        )
+    return _tls_material
+
+
+def _remote_url(ip, port):
+    "https url of ip:port, plain concatenation instead of format parsing"
+    return "https://" + str(ip) + ":" + str(port) + "/"
+
+
 class ServePrepare(pulumi.ComponentResource):
     """a serve-prepare component to configure a future available web resource
 
@@ -892,59 +1269,81 @@ class ServePrepare(pulumi.ComponentResource):
         port_range: int = 3000,
         opts: pulumi.Input[object] = None,
     ) -> None:
-        from .authority import config, ca_factory, provision_host_tls
+        import pulumi_command as command
+
+        from .authority import config
+
+        # fail before any child resource is registered
+        if port_range < 0 or port_base < 1 or port_base + port_range > 65535:
+            raise ValueError(
+                "Invalid port_base: {} port_range: {}".format(port_base, port_range)
+            )
 
         super().__init__("pkg:index:ServeConfigure", resource_name, None, opts)
 
         forward_config = config.get_object("port_forward", {"enabled": False})
+        static_config = _load(config_input) if config_input else {}
+        serve_ip = get_default_host_ip()
 
         self.local_port_config = TimedResource(
-            "local-port-config",
+            "{}_local_port_config".format(resource_name),
             creation_fn=lambda: str(random.randint(port_base, port_base + port_range)),
             timeout_sec=timeout_sec,
-            opts=pulumi.ResourceOptions(parent=self),
+            # resource was named "local-port-config", keep its state and port
+            opts=pulumi.ResourceOptions(
+                parent=self, aliases=[pulumi.Alias(name="local-port-config")]
+            ),
         )
         serve_port = self.local_port_config.output["value"].apply(lambda v: int(v))
 
-        self.config = {
-            "serve_port": serve_port,
-            "timeout": timeout_sec,
-            "cert": provision_host_tls.chain,
-            "key": provision_host_tls.key.private_key_pem,
-            "ca_cert": ca_factory.root_cert_pem,
-            "mtls": True,
-            "payload": None,
-            "remote_url": "https://{ip}:{port}/".format(
-                ip=get_default_host_ip(),
-                port=serve_port,
-            ),
-            "port_forward": {"lifetime_sec": timeout_sec},
-            # short lifetime of forward for fast reuse
-        }
-
-        if config_input:
-            self.config.update(yaml.safe_load(config_input))
+        def build_config(args):
+            # cert, key and ca_cert are shared between all ServePrepare of the stack
+            port, (cert, key, ca_cert) = args
+            merged_config = {
+                "serve_port": port,
+                "timeout": timeout_sec,
+                "cert": cert,
+                "key": key,
+                "ca_cert": ca_cert,
+                "mtls": True,
+                "payload": None,
+                "remote_url": _remote_url(serve_ip, port),
+                "port_forward": {"lifetime_sec": timeout_sec},
+                # short lifetime of forward for fast reuse
+            }
+            merged_config.update(static_config)
+            if forward_config.get("enabled", False):
+                merged_config["port_forward"].update(forward_config)
+            return merged_config
+
+        self.config = pulumi.Output.all(serve_port, _get_tls_material()).apply(
+            build_config
+        )
 
-        if forward_config.enabled:
-            self.config["port_forward"].update(forward_config)
+        if forward_config.get("enabled", False):
             self.forward = command.local.Command(
                 resource_name + "_forward",
-                create="scripts/port_forward.py --yaml-from-stdin --yaml-to-stdout",
-                stdin=self.config,
+                create=exec_cmdline(
+                    os.path.join(scripts_dir, "port_forward.py"),
+                    "--json-from-stdin",
+                    "--json-to-stdout",
+                ),
+                stdin=self.config.apply(json.dumps),
                 opts=pulumi.ResourceOptions(parent=self),
             )
-            self.config = yaml.safe_load(self.forward.stdout.yaml)
-            self.config.update(
-                {
-                    "remote_url": "https://{ip}:{port}/".format(
-                        ip=self.config["port_forward"]["public_ip"],
-                        port=self.config["port_forward"]["public_port"],
-                    ),
-                }
-            )
-            self.result = self.forward.stdout
-        else:
-            self.result = yaml.safe_dump(self.config)
+
+            def forwarded_config(stdout):
+                # parse and point remote_url to the public side in one step
+                forwarded = json.loads(stdout)
+                forwarded["remote_url"] = _remote_url(
+                    forwarded["port_forward"]["public_ip"],
+                    forwarded["port_forward"]["public_port"],
+                )
+                return forwarded
+
+            self.config = self.forward.stdout.apply(forwarded_config)
+
+        self.result = self.config.apply(_dump)
 
         self.register_outputs({})
 
@@ -953,13 +1352,16 @@ class ServeOnce(pulumi.ComponentResource):
     """one time secure web data serve for eg. ignition data, or one time webhook with retrieved POST data"""
 
     def __init__(self, resource_name, config, opts=None):
+        import pulumi_command as command
+
         super().__init__("pkg:index:ServeOnce", resource_name, None, opts)
 
         self.executed = command.local.Command(
             resource_name,
-            create="scripts/serve_once.py --yes",
-            stdin=yaml.safe_dump(config),
-            depends_on=config,
+            create=exec_cmdline(
+                os.path.join(scripts_dir, "serve_once.py"), "--json-from-stdin", "--yes"
+            ),
+            stdin=_maybe_apply(config, json.dumps),
             opts=pulumi.ResourceOptions(parent=self),
         )
         self.result = self.executed.stdout
@@ -970,12 +1372,20 @@ class WriteRemoveable(pulumi.ComponentResource):
     """Writes image from given image_path to specified serial_numbered removable storage device"""
 
     def __init__(self, resource_name, image_path, serial_number, opts=None):
+        import pulumi_command as command
+
         super().__init__("pkg:index:WriteRemoveable", resource_name, None, opts)
 
         self.executed = command.local.Command(
             resource_name,
-            create="scripts/write_removeable.py --yes {} {}".format(
-                image_path, serial_number
+            create=pulumi.Output.all(image_path, serial_number).apply(
+                lambda args: exec_cmdline(
+                    os.path.join(scripts_dir, "write_removeable.py"),
+                    "--source-image",
+                    args[0],
+                    "--dest-serial",
+                    args[1],
+                )
             ),
             opts=pulumi.ResourceOptions(parent=self),
         )
@@ -993,17 +1403,29 @@ def serve_prepare(resource_name, config_input="", timeout_sec=45, opts=None):
 
 
 def serve_once(resource_name, payload, config, opts=None):
-    this_config = copy.deepcopy(config)
-    this_config.update({"payload": payload})
+    if isinstance(payload, pulumi.Output):
+        this_config = pulumi.Output.all(config, payload).apply(
+            lambda args: {**args[0], "payload": args[1]}
+        )
+    else:
+        this_config = _maybe_apply(config, lambda c: {**c, "payload": payload})
     return ServeOnce("serve_once_{}".format(resource_name), this_config, opts=opts)
 
 
 def serve_simple(resource_name, yaml_str, opts=None):
+    """serve yaml_str configured data once, using a ServePrepare and a ServeOnce
+
+    - both resources are registered on call, the serving is the wanted side effect;
+        use pulumi --target to restrict which ones are created
+
+    """
     this_config = ServePrepare(
         "serve_prepare_{}".format(resource_name),
-        config_input=yaml.safe_load(yaml_str),
+        config_input=yaml_str,
+    )
+    return ServeOnce(
+        "serve_once_{}".format(resource_name), this_config.config, opts=opts
     )
-    return ServeOnce("serve_once_{}".format(resource_name), this_config, opts=opts)
 
 
 def write_removeable(resource_name, image_path, serial_number, opts=None):